@@ -1,49 +1,97 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from typing import Dict, Any, TypedDict, List, Optional
-import json
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Dict, Any, TypedDict, List, Optional, Tuple
+from collections import deque
+from contextlib import asynccontextmanager
+import msgspec
+import orjson
+import redis.asyncio
 import asyncio
+import os
 import re
 from datetime import datetime
 import uuid
 
-app = FastAPI(title="Negotiation Agent API")
+# Session storage lives in Redis so the app can run with multiple workers.
+# The key TTLs replace the old in-process sweeper: live sessions expire after
+# an hour idle, archived (finished) sessions after five minutes.
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+SESSION_KEY_PREFIX = "sess:"
+SESSION_IDLE_TTL = 60 * 60     # seconds a live session survives without activity
+FINISHED_SESSION_TTL = 5 * 60  # seconds a finished session's summary stays readable
 
-# Add CORS middleware
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.redis = redis.asyncio.Redis.from_url(REDIS_URL)
+    yield
+    await app.state.redis.aclose()
+
+app = FastAPI(title="Negotiation Agent API", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Add CORS middleware. An explicit origin list (instead of "*" with
+# credentials) lets the middleware take its static-header fast path, and
+# max_age lets browsers cache preflight responses for a day.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, specify your frontend URL
+    allow_origins=[os.environ.get("FRONTEND_ORIGIN", "http://localhost:3000")],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,
 )
 
-# Pydantic models for API
-class NegotiationStart(BaseModel):
+# msgspec models for API (C-level validation, much faster than BaseModel)
+class NegotiationStart(msgspec.Struct):
     budget: int
-    campaign_type: Optional[str] = "social_media"
-    duration: Optional[str] = "2_weeks"
+    campaign_type: str = "social_media"
+    duration: str = "2_weeks"
 
-class UserResponse(BaseModel):
+class UserResponse(msgspec.Struct):
     session_id: str
     message: str
     current_state: Optional[Dict[str, Any]] = None
 
-class NegotiationResponse(BaseModel):
+class NegotiationResponse(msgspec.Struct):
     type: str  # "message", "options", "complete"
     content: str
-    options: Optional[List[str]] = None
     state: Dict[str, Any]
+    options: Optional[List[str]] = None
     is_complete: bool = False
 
+class StateSummary(msgspec.Struct):
+    negotiation_phase: str
+    brand_offer: int
+    influencer_offer: int
+    negotiation_rounds: int
+    last_activity: str
+    agreed_price: Optional[int] = None
+
+def decode_body(body: bytes, model):
+    """Validate a raw request body against a msgspec Struct"""
+    try:
+        return msgspec.json.decode(body, type=model)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+def summarize_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Shallow projection of session state for response bodies.
+
+    The full state (including the message log) keeps growing with each
+    round, so it's only exposed via GET /session/{session_id}.
+    """
+    return msgspec.to_builtins(
+        StateSummary(**{key: state[key] for key in StateSummary.__struct_fields__})
+    )
+
 # Define negotiation state
 class NegotiationState(TypedDict):
     messages: List[str]
     budget: int
     campaign_type: str
     duration: str
+    campaign_display: str
+    duration_display: str
     brand_offer: int
     influencer_offer: int
     agreed_price: Optional[int]
@@ -54,219 +102,317 @@ class NegotiationState(TypedDict):
     created_at: str
     last_activity: str
 
-# Store active sessions
-active_sessions: Dict[str, Dict[str, Any]] = {}
+# Cap on the message log kept per session
+MAX_MESSAGES = 50
+
+# Distributed per-session lock settings. The lock lives in Redis (SET NX PX
+# via redis-py's Lock), so it serializes the read-process-write sequence
+# across all workers and expires on its own — no per-process lock map to
+# grow without bound.
+SESSION_LOCK_PREFIX = "lock:"
+SESSION_LOCK_TTL = 10        # seconds before an abandoned lock auto-releases
+SESSION_LOCK_WAIT = 5        # seconds to wait for the lock before giving up
+SESSION_LOCK_RETRY = 0.05    # seconds between acquire attempts
+
+@asynccontextmanager
+async def session_lock(r: redis.asyncio.Redis, session_id: str):
+    """Serialize concurrent responses for a session across all workers"""
+    lock = r.lock(
+        SESSION_LOCK_PREFIX + session_id,
+        timeout=SESSION_LOCK_TTL,
+        blocking_timeout=SESSION_LOCK_WAIT,
+        sleep=SESSION_LOCK_RETRY,
+    )
+    if not await lock.acquire():
+        raise HTTPException(status_code=503, detail="Session is busy, please retry")
+    try:
+        yield
+    finally:
+        try:
+            await lock.release()
+        except redis.exceptions.LockError:
+            pass  # lock expired mid-request; nothing left to release
+
+def session_key(session_id: str) -> str:
+    return SESSION_KEY_PREFIX + session_id
+
+async def save_session(r: redis.asyncio.Redis, session_id: str, session: Dict[str, Any], ttl: int = SESSION_IDLE_TTL):
+    """Write a session blob to Redis; each write refreshes the TTL"""
+    # default=list turns the messages deque into a JSON array
+    await r.set(session_key(session_id), orjson.dumps(session, default=list), ex=ttl)
+
+async def load_session(r: redis.asyncio.Redis, session_id: str) -> Optional[Dict[str, Any]]:
+    """Read a session blob from Redis, or None if expired/unknown"""
+    data = await r.get(session_key(session_id))
+    if data is None:
+        return None
+    session = orjson.loads(data)
+    state = session.get("state")
+    if state is not None:
+        state["messages"] = deque(state.get("messages", ()), maxlen=MAX_MESSAGES)
+    return session
+
+def archive_session(session: Dict[str, Any], closed_at: str) -> Dict[str, Any]:
+    """Build the compact summary stored for a finished session.
+
+    Completed sessions are never mutated again, so the message log and user
+    input are dropped and the summary expires on the shorter finished TTL.
+    """
+    state = session["state"]
+    return {
+        "summary": {
+            "phase": state.get("negotiation_phase", "unknown"),
+            "budget": state.get("budget", 0),
+            "agreed_price": state.get("agreed_price"),
+            "rounds": state.get("negotiation_rounds", 0),
+            "closed_at": closed_at
+        },
+        "created_at": session["created_at"]
+    }
+
+# Pre-compiled patterns and keyword sets for the per-turn hot path
+_PRICE_RE = re.compile(r'₹?(\d+)')
+_ACCEPT_KWS = ("accept", "yes")
+_QUESTION_KWS = frozenset(("campaign", "what", "about", "details", "?"))
+
+# Response templates declared once; each turn only formats the values
+_INITIAL_OFFER_TMPL = "🏢 Brand: Hello! We're excited to work with you on our {campaign} campaign.\n🏢 Brand: This is a {duration} campaign, and our budget is ₹{budget:,}.\n🏢 Brand: What are your thoughts on this collaboration?"
+_ACCEPT_TMPL = "🎭 Influencer: I accept your offer of ₹{offer:,}!\n🏢 Brand: Excellent! We have a deal!"
+_COUNTER_TMPL = "🎭 Influencer: I was thinking more along the lines of ₹{offer:,}.\n🏢 Brand: Let me consider your offer..."
+_DETAILS_TMPL = "🏢 Brand: This is a {campaign} campaign for our new product launch.\n🏢 Brand: Duration: {duration}, with authentic content in your style.\n🏢 Brand: We need 3-5 posts showcasing our product naturally.\n🏢 Brand: So, what do you think about our offer of ₹{offer:,}?"
+_CLARIFY_TMPL = "🏢 Brand: I'd like to understand your position better. Are you interested in accepting ₹{offer:,}, or do you have a different rate in mind?"
+_BRAND_ACCEPT_TMPL = "🏢 Brand: ₹{offer:,} works perfectly for us! Let's proceed with the collaboration."
+_BRAND_STRETCH_TMPL = "🏢 Brand: ₹{offer:,} is a bit higher than our initial budget, but we really like your content. We can agree to ₹{offer:,}!"
+_FINAL_OFFER_TMPL = "🏢 Brand: ₹{offer:,} is beyond our current budget. The highest we can go is ₹{final:,}. This is our final offer."
+_FINAL_ACCEPT_TMPL = "🎭 Influencer: Yes, I'll accept ₹{offer:,}!\n🏢 Brand: Excellent! We have a deal at ₹{offer:,}!"
+_FINAL_DECLINE_TMPL = "🎭 Influencer: I appreciate the offer, but I can't accept ₹{offer:,}.\n🏢 Brand: We understand. Unfortunately, we can't go higher. Thanks for considering!"
+
+# (state_patch, bot_response, options, is_complete) returned by each step function
+StepResult = Tuple[Dict[str, Any], str, List[str], bool]
+
+def apply_state_patch(state: NegotiationState, state_patch: Dict[str, Any]):
+    """Merge a step function's state patch into session state"""
+    messages = state_patch.pop("messages", None)
+    if messages:
+        state["messages"].extend(messages)
+    state.update(state_patch)
 
 def create_session_id() -> str:
-    return str(uuid.uuid4())
+    # .hex skips the dash-formatting pass of str(uuid4()) and makes a
+    # shorter dict key (32 chars instead of 36)
+    return uuid.uuid4().hex
+
+# Characters per SSE event; content is computed synchronously so there is no
+# need to trickle it out character by character
+STREAM_CHUNK_SIZE = 16
+# Set a non-zero delay to simulate token-by-token output during debugging
+STREAM_DEBUG_DELAY = 0.0
+# Responses shorter than this go out as a single SSE event
+MIN_STREAM_LENGTH = 64
 
-async def stream_message(content: str, delay: float = 0.03):
-    """Stream message character by character"""
-    for char in content:
-        yield f"data: {json.dumps({'type': 'stream', 'content': char})}\n\n"
-        await asyncio.sleep(delay)
+# Pre-encoded SSE frame pieces: the envelope around each chunk is fixed, so
+# only the content string needs JSON encoding (for escaping). Yielding bytes
+# also lets Starlette skip the str->bytes encode per frame.
+_SSE_STREAM_PREFIX = b'data: {"type":"stream","content":'
+_SSE_DATA_PREFIX = b'data: '
+_SSE_SUFFIX = b'}\n\n'
+_SSE_END = b'\n\n'
 
-def brand_initial_offer(state: NegotiationState) -> Dict[str, Any]:
+def sse_stream_frame(content: str) -> bytes:
+    """Build a single stream-type SSE frame"""
+    return _SSE_STREAM_PREFIX + orjson.dumps(content) + _SSE_SUFFIX
+
+async def stream_message(content: str, delay: float = STREAM_DEBUG_DELAY):
+    """Stream message in small chunks"""
+    for i in range(0, len(content), STREAM_CHUNK_SIZE):
+        yield sse_stream_frame(content[i:i + STREAM_CHUNK_SIZE])
+        if delay:
+            await asyncio.sleep(delay)
+
+def brand_initial_offer(state: NegotiationState, now_iso: str) -> StepResult:
     """Brand makes initial offer"""
     budget = state.get("budget")
-    campaign_type = state.get("campaign_type", "social media")
-    duration = state.get("duration", "2 weeks")
-    
+    # Display strings are formatted once at session start
+    campaign_display = state.get("campaign_display", "Social Media")
+    duration_display = state.get("duration_display", "2 Weeks")
+
     if not budget:
         raise ValueError("Missing budget in state")
-    
-    # Format campaign type for display
-    campaign_display = campaign_type.replace("_", " ").title()
-    duration_display = duration.replace("_", " ").title()
-    
-    response = f"🏢 Brand: Hello! We're excited to work with you on our {campaign_display} campaign.\n🏢 Brand: This is a {duration_display} campaign, and our budget is ₹{budget:,}.\n🏢 Brand: What are your thoughts on this collaboration?"
-    
-    return {
-        "messages": [f"Brand offers ₹{budget:,} for {campaign_display} campaign ({duration_display})"],
-        "brand_offer": budget,
-        "negotiation_phase": "waiting_for_influencer_response",
-        "negotiation_rounds": state.get("negotiation_rounds", 0) + 1,
-        "bot_response": response,
-        "options": ["Accept the offer", "Counter with your price", "Ask about campaign details"],
-        "last_activity": datetime.now().isoformat()
-    }
 
-def handle_influencer_response(state: NegotiationState) -> Dict[str, Any]:
+    response = _INITIAL_OFFER_TMPL.format(campaign=campaign_display, duration=duration_display, budget=budget)
+
+    state_patch = dict(
+        messages=[f"Brand offers ₹{budget:,} for {campaign_display} campaign ({duration_display})"],
+        brand_offer=budget,
+        negotiation_phase="waiting_for_influencer_response",
+        negotiation_rounds=state.get("negotiation_rounds", 0) + 1,
+        last_activity=now_iso
+    )
+    return state_patch, response, ["Accept the offer", "Counter with your price", "Ask about campaign details"], False
+
+def handle_influencer_response(state: NegotiationState, now_iso: str) -> StepResult:
     """Handle influencer's response to brand offer"""
     brand_offer = state.get("brand_offer")
     user_input = state.get("user_input", "")
+    user_input_lower = user_input.lower()
     rounds = state.get("negotiation_rounds", 0)
-    
+
     # Parse user response
-    if "accept" in user_input.lower() or "yes" in user_input.lower():
-        response = f"🎭 Influencer: I accept your offer of ₹{brand_offer:,}!\n🏢 Brand: Excellent! We have a deal!"
-        return {
-            "messages": [f"Influencer accepts ₹{brand_offer:,}"],
-            "agreed_price": brand_offer,
-            "negotiation_phase": "completed",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "is_complete": True,
-            "last_activity": datetime.now().isoformat()
-        }
-    
+    if any(kw in user_input_lower for kw in _ACCEPT_KWS):
+        response = _ACCEPT_TMPL.format(offer=brand_offer)
+        state_patch = dict(
+            messages=[f"Influencer accepts ₹{brand_offer:,}"],
+            agreed_price=brand_offer,
+            negotiation_phase="completed",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, [], True
+
     # Check for counter-offer
-    price_match = re.search(r'₹?(\d+)', user_input)
+    price_match = _PRICE_RE.search(user_input)
     if price_match:
         counter_offer = int(price_match.group(1))
-        response = f"🎭 Influencer: I was thinking more along the lines of ₹{counter_offer:,}.\n🏢 Brand: Let me consider your offer..."
-        return {
-            "messages": [f"Influencer counters with ₹{counter_offer:,}"],
-            "influencer_offer": counter_offer,
-            "negotiation_phase": "brand_considering",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "last_activity": datetime.now().isoformat()
-        }
+        response = _COUNTER_TMPL.format(offer=counter_offer)
+        state_patch = dict(
+            messages=[f"Influencer counters with ₹{counter_offer:,}"],
+            influencer_offer=counter_offer,
+            negotiation_phase="brand_considering",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, [], False
     
     # Handle questions about campaign
-    if any(word in user_input.lower() for word in ["campaign", "what", "about", "details", "?"]):
-        campaign_type = state.get("campaign_type", "social_media").replace("_", " ")
-        duration = state.get("duration", "2_weeks").replace("_", " ")
-        
-        response = f"🏢 Brand: This is a {campaign_type} campaign for our new product launch.\n🏢 Brand: Duration: {duration}, with authentic content in your style.\n🏢 Brand: We need 3-5 posts showcasing our product naturally.\n🏢 Brand: So, what do you think about our offer of ₹{brand_offer:,}?"
-        return {
-            "messages": [f"Brand explains campaign details"],
-            "negotiation_phase": "waiting_for_decision",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "options": [f"Accept ₹{brand_offer:,}", "Make counter-offer", "Need more details"],
-            "last_activity": datetime.now().isoformat()
-        }
-    
+    if any(word in user_input_lower for word in _QUESTION_KWS):
+        campaign_display = state.get("campaign_display", "Social Media")
+        duration_display = state.get("duration_display", "2 Weeks")
+
+        response = _DETAILS_TMPL.format(campaign=campaign_display, duration=duration_display, offer=brand_offer)
+        state_patch = dict(
+            messages=["Brand explains campaign details"],
+            negotiation_phase="waiting_for_decision",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, [f"Accept ₹{brand_offer:,}", "Make counter-offer", "Need more details"], False
+
     # Default response
-    response = f"🏢 Brand: I'd like to understand your position better. Are you interested in accepting ₹{brand_offer:,}, or do you have a different rate in mind?"
-    return {
-        "messages": [f"Brand asks for clarification"],
-        "negotiation_phase": "waiting_for_decision",
-        "negotiation_rounds": rounds + 1,
-        "bot_response": response,
-        "options": [f"Accept ₹{brand_offer:,}", "Make counter-offer"],
-        "last_activity": datetime.now().isoformat()
-    }
+    response = _CLARIFY_TMPL.format(offer=brand_offer)
+    state_patch = dict(
+        messages=["Brand asks for clarification"],
+        negotiation_phase="waiting_for_decision",
+        negotiation_rounds=rounds + 1,
+        last_activity=now_iso
+    )
+    return state_patch, response, [f"Accept ₹{brand_offer:,}", "Make counter-offer"], False
 
-def brand_considers_counter(state: NegotiationState) -> Dict[str, Any]:
+def brand_considers_counter(state: NegotiationState, now_iso: str) -> StepResult:
     """Brand considers influencer's counter offer"""
     influencer_offer = state.get("influencer_offer")
     budget = state.get("budget")
     rounds = state.get("negotiation_rounds", 0)
-    
+
     if not influencer_offer or not budget:
-        return {"negotiation_phase": "error"}
-    
+        return {"negotiation_phase": "error"}, "", [], False
+
     max_budget = int(budget * 1.15)  # Brand can go 15% over initial budget
-    
+
     if influencer_offer <= budget:
-        response = f"🏢 Brand: ₹{influencer_offer:,} works perfectly for us! Let's proceed with the collaboration."
-        return {
-            "messages": [f"Brand accepts ₹{influencer_offer:,}"],
-            "agreed_price": influencer_offer,
-            "negotiation_phase": "completed",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "is_complete": True,
-            "last_activity": datetime.now().isoformat()
-        }
+        response = _BRAND_ACCEPT_TMPL.format(offer=influencer_offer)
+        state_patch = dict(
+            messages=[f"Brand accepts ₹{influencer_offer:,}"],
+            agreed_price=influencer_offer,
+            negotiation_phase="completed",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, [], True
     elif influencer_offer <= max_budget:
-        response = f"🏢 Brand: ₹{influencer_offer:,} is a bit higher than our initial budget, but we really like your content. We can agree to ₹{influencer_offer:,}!"
-        return {
-            "messages": [f"Brand accepts ₹{influencer_offer:,}"],
-            "agreed_price": influencer_offer,
-            "negotiation_phase": "completed",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "is_complete": True,
-            "last_activity": datetime.now().isoformat()
-        }
+        response = _BRAND_STRETCH_TMPL.format(offer=influencer_offer)
+        state_patch = dict(
+            messages=[f"Brand accepts ₹{influencer_offer:,}"],
+            agreed_price=influencer_offer,
+            negotiation_phase="completed",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, [], True
     else:
         final_offer = max_budget
-        response = f"🏢 Brand: ₹{influencer_offer:,} is beyond our current budget. The highest we can go is ₹{final_offer:,}. This is our final offer."
-        return {
-            "messages": [f"Brand's final offer: ₹{final_offer:,}"],
-            "brand_offer": final_offer,
-            "negotiation_phase": "final_decision",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "options": ["Accept final offer", "Decline offer"],
-            "last_activity": datetime.now().isoformat()
-        }
+        response = _FINAL_OFFER_TMPL.format(offer=influencer_offer, final=final_offer)
+        state_patch = dict(
+            messages=[f"Brand's final offer: ₹{final_offer:,}"],
+            brand_offer=final_offer,
+            negotiation_phase="final_decision",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, ["Accept final offer", "Decline offer"], False
 
-def handle_final_decision(state: NegotiationState) -> Dict[str, Any]:
+def handle_final_decision(state: NegotiationState, now_iso: str) -> StepResult:
     """Handle influencer's decision on brand's final offer"""
     final_offer = state.get("brand_offer")
-    user_input = state.get("user_input", "")
+    user_input_lower = state.get("user_input", "").lower()
     rounds = state.get("negotiation_rounds", 0)
-    
-    if "accept" in user_input.lower() or "yes" in user_input.lower():
-        response = f"🎭 Influencer: Yes, I'll accept ₹{final_offer:,}!\n🏢 Brand: Excellent! We have a deal at ₹{final_offer:,}!"
-        return {
-            "messages": [f"Influencer accepts final offer of ₹{final_offer:,}"],
-            "agreed_price": final_offer,
-            "negotiation_phase": "completed",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "is_complete": True,
-            "last_activity": datetime.now().isoformat()
-        }
-    else:
-        response = f"🎭 Influencer: I appreciate the offer, but I can't accept ₹{final_offer:,}.\n🏢 Brand: We understand. Unfortunately, we can't go higher. Thanks for considering!"
-        return {
-            "messages": ["Negotiation failed - no agreement reached"],
-            "agreed_price": None,
-            "negotiation_phase": "failed",
-            "negotiation_rounds": rounds + 1,
-            "bot_response": response,
-            "is_complete": True,
-            "last_activity": datetime.now().isoformat()
-        }
 
-def determine_next_step(state: NegotiationState) -> str:
-    """Determine next step based on current state"""
-    phase = state.get("negotiation_phase", "")
-    user_input = state.get("user_input", "")
-    
-    if phase == "waiting_for_influencer_response" or phase == "waiting_for_decision":
-        return "handle_response"
-    elif phase == "brand_considering":
-        return "brand_considers"
-    elif phase == "final_decision":
-        return "final_choice"
+    if any(kw in user_input_lower for kw in _ACCEPT_KWS):
+        response = _FINAL_ACCEPT_TMPL.format(offer=final_offer)
+        state_patch = dict(
+            messages=[f"Influencer accepts final offer of ₹{final_offer:,}"],
+            agreed_price=final_offer,
+            negotiation_phase="completed",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, [], True
     else:
-        return "handle_response"
+        response = _FINAL_DECLINE_TMPL.format(offer=final_offer)
+        state_patch = dict(
+            messages=["Negotiation failed - no agreement reached"],
+            agreed_price=None,
+            negotiation_phase="failed",
+            negotiation_rounds=rounds + 1,
+            last_activity=now_iso
+        )
+        return state_patch, response, [], True
 
-# Simple state machine implementation
-def process_negotiation_step(state: NegotiationState) -> Dict[str, Any]:
+def _error_step(state: NegotiationState, now_iso: str) -> StepResult:
+    """Fallback for unknown phases"""
+    return {"negotiation_phase": "error"}, "Something went wrong. Please start over.", [], False
+
+# Simple state machine implementation: one lookup replaces the phase if/elif chain
+_DISPATCH = {
+    "initial": brand_initial_offer,
+    "waiting_for_influencer_response": handle_influencer_response,
+    "waiting_for_decision": handle_influencer_response,
+    "brand_considering": brand_considers_counter,
+    "final_decision": handle_final_decision,
+}
+
+def process_negotiation_step(state: NegotiationState, now_iso: Optional[str] = None) -> StepResult:
     """Process one step of negotiation"""
-    phase = state.get("negotiation_phase", "initial")
-    
-    if phase == "initial":
-        return brand_initial_offer(state)
-    elif phase in ["waiting_for_influencer_response", "waiting_for_decision"]:
-        return handle_influencer_response(state)
-    elif phase == "brand_considering":
-        return brand_considers_counter(state)
-    elif phase == "final_decision":
-        return handle_final_decision(state)
-    else:
-        return {"negotiation_phase": "error", "bot_response": "Something went wrong. Please start over."}
+    if now_iso is None:
+        now_iso = datetime.now().isoformat()
+    step = _DISPATCH.get(state.get("negotiation_phase", "initial"), _error_step)
+    return step(state, now_iso)
 
 # API Routes
 @app.post("/start-negotiation")
-async def start_negotiation(request: NegotiationStart):
+async def start_negotiation(http_request: Request):
     """Start a new negotiation session"""
+    request = decode_body(await http_request.body(), NegotiationStart)
     session_id = create_session_id()
-    
+    now_iso = datetime.now().isoformat()
+
     # Initialize state
     initial_state: NegotiationState = {
-        "messages": [],
+        "messages": deque(maxlen=MAX_MESSAGES),  # cap the log so long sessions stay bounded
         "budget": request.budget,
         "campaign_type": request.campaign_type,
         "duration": request.duration,
+        "campaign_display": request.campaign_type.replace("_", " ").title(),
+        "duration_display": request.duration.replace("_", " ").title(),
         "brand_offer": 0,
         "influencer_offer": 0,
         "agreed_price": None,
@@ -274,167 +420,212 @@ async def start_negotiation(request: NegotiationStart):
         "negotiation_rounds": 0,
         "user_input": "",
         "session_id": session_id,
-        "created_at": datetime.now().isoformat(),
-        "last_activity": datetime.now().isoformat()
+        "created_at": now_iso,
+        "last_activity": now_iso
     }
-    
+
     try:
         # Process initial step
-        result = process_negotiation_step(initial_state)
-        
-        # Update state with result
-        for key, value in result.items():
-            if key != "bot_response" and key != "options":
-                initial_state[key] = value
-        
+        state_patch, bot_response, options, is_complete = await asyncio.to_thread(process_negotiation_step, initial_state, now_iso)
+        apply_state_patch(initial_state, state_patch)
+
         # Store session
-        active_sessions[session_id] = {
+        await save_session(http_request.app.state.redis, session_id, {
             "state": initial_state,
-            "created_at": datetime.now().isoformat()
-        }
-        
+            "created_at": now_iso
+        })
+
         return {
             "session_id": session_id,
             "type": "message",
-            "content": result.get("bot_response", ""),
-            "options": result.get("options", []),
-            "state": initial_state,
-            "is_complete": result.get("is_complete", False)
+            "content": bot_response,
+            "options": options,
+            "state": summarize_state(initial_state),
+            "is_complete": is_complete
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/respond")
-async def respond_to_negotiation(request: UserResponse):
+async def respond_to_negotiation(http_request: Request):
     """Handle user response in negotiation"""
-    if request.session_id not in active_sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = active_sessions[request.session_id]
-    current_state = session["state"]
-    
-    # Update state with user input
-    current_state["user_input"] = request.message
-    current_state["last_activity"] = datetime.now().isoformat()
-    
-    try:
-        # Process response
-        result = process_negotiation_step(current_state)
-        
-        # Update state with result
-        for key, value in result.items():
-            if key != "bot_response" and key != "options":
-                current_state[key] = value
-        
-        return {
-            "session_id": request.session_id,
-            "type": "message",
-            "content": result.get("bot_response", ""),
-            "options": result.get("options", []),
-            "state": current_state,
-            "is_complete": result.get("is_complete", False)
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    request = decode_body(await http_request.body(), UserResponse)
+    r = http_request.app.state.redis
+
+    # Serialize concurrent responses for the same session
+    async with session_lock(r, request.session_id):
+        session = await load_session(r, request.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        if "summary" in session:
+            raise HTTPException(status_code=409, detail="Negotiation already completed")
+        current_state = session["state"]
+
+        # Update state with user input
+        now_iso = datetime.now().isoformat()
+        current_state["user_input"] = request.message
+        current_state["last_activity"] = now_iso
+
+        try:
+            # Process response
+            state_patch, bot_response, options, is_complete = await asyncio.to_thread(process_negotiation_step, current_state, now_iso)
+            apply_state_patch(current_state, state_patch)
+
+            response = {
+                "session_id": request.session_id,
+                "type": "message",
+                "content": bot_response,
+                "options": options,
+                "state": summarize_state(current_state),
+                "is_complete": is_complete
+            }
+            if is_complete:
+                await save_session(r, request.session_id, archive_session(session, now_iso), ttl=FINISHED_SESSION_TTL)
+            else:
+                await save_session(r, request.session_id, session)
+            return response
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/respond-stream")
-async def respond_to_negotiation_stream(request: UserResponse):
+async def respond_to_negotiation_stream(http_request: Request, stream: bool = True):
     """Handle user response with streaming response"""
-    if request.session_id not in active_sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = active_sessions[request.session_id]
-    current_state = session["state"]
-    current_state["user_input"] = request.message
-    current_state["last_activity"] = datetime.now().isoformat()
-    
-    async def generate_stream():
+    request = decode_body(await http_request.body(), UserResponse)
+    r = http_request.app.state.redis
+
+    # Process the step up front (serialized per session) so the generator
+    # only has to emit; the lock is never held while a client drains the
+    # stream
+    async with session_lock(r, request.session_id):
+        session = await load_session(r, request.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        if "summary" in session:
+            raise HTTPException(status_code=409, detail="Negotiation already completed")
+        current_state = session["state"]
+
+        now_iso = datetime.now().isoformat()
+        current_state["user_input"] = request.message
+        current_state["last_activity"] = now_iso
+
         try:
-            # Process the response
-            result = process_negotiation_step(current_state)
-            
-            # Update state with result
-            for key, value in result.items():
-                if key != "bot_response" and key != "options":
-                    current_state[key] = value
-            
-            # Stream the bot response
-            bot_response = result.get("bot_response", "")
-            
-            # Stream character by character
+            state_patch, bot_response, options, is_complete = await asyncio.to_thread(process_negotiation_step, current_state, now_iso)
+            apply_state_patch(current_state, state_patch)
+            state_summary = summarize_state(current_state)
+            if is_complete:
+                await save_session(r, request.session_id, archive_session(session, now_iso), ttl=FINISHED_SESSION_TTL)
+            else:
+                await save_session(r, request.session_id, session)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    async def generate_stream():
+        # Short responses (and ?stream=false) go out in one flush; longer
+        # ones are chunked
+        if not stream or len(bot_response) < MIN_STREAM_LENGTH:
+            yield sse_stream_frame(bot_response)
+        else:
             async for chunk in stream_message(bot_response):
                 yield chunk
-            
-            # Send final data
-            final_data = {
-                "type": "complete",
-                "session_id": request.session_id,
-                "options": result.get("options", []),
-                "state": current_state,
-                "is_complete": result.get("is_complete", False)
-            }
-            yield f"data: {json.dumps(final_data)}\n\n"
-            
-        except Exception as e:
-            error_data = {"type": "error", "content": str(e)}
-            yield f"data: {json.dumps(error_data)}\n\n"
+
+        # Send final data
+        final_data = {
+            "type": "complete",
+            "session_id": request.session_id,
+            "options": options,
+            "state": state_summary,
+            "is_complete": is_complete
+        }
+        yield _SSE_DATA_PREFIX + orjson.dumps(final_data) + _SSE_END
     
     return StreamingResponse(
         generate_stream(),
-        media_type="text/plain",
+        media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
-            "Content-Type": "text/event-stream",
+            "X-Accel-Buffering": "no",  # tell nginx/proxies to forward chunks immediately
         }
     )
 
 @app.get("/sessions")
-async def get_active_sessions():
+async def get_active_sessions(request: Request):
     """Get all active sessions"""
+    r = request.app.state.redis
     session_list = []
-    
-    for session_id, session_data in active_sessions.items():
-        state = session_data["state"]
-        session_info = {
-            "session_id": session_id,
-            "created_at": session_data["created_at"],
-            "budget": state.get("budget", 0),
-            "status": state.get("negotiation_phase", "unknown"),
-            "last_activity": state.get("last_activity", session_data["created_at"]),
-            "rounds": state.get("negotiation_rounds", 0)
-        }
+
+    async for key in r.scan_iter(match=SESSION_KEY_PREFIX + "*"):
+        data = await r.get(key)
+        if data is None:  # expired between SCAN and GET
+            continue
+        session_data = orjson.loads(data)
+        key_str = key.decode() if isinstance(key, bytes) else key
+        session_id = key_str[len(SESSION_KEY_PREFIX):]
+        summary = session_data.get("summary")
+        if summary is not None:
+            session_info = {
+                "session_id": session_id,
+                "created_at": session_data["created_at"],
+                "budget": summary["budget"],
+                "status": summary["phase"],
+                "last_activity": summary["closed_at"],
+                "rounds": summary["rounds"]
+            }
+        else:
+            state = session_data["state"]
+            session_info = {
+                "session_id": session_id,
+                "created_at": session_data["created_at"],
+                "budget": state.get("budget", 0),
+                "status": state.get("negotiation_phase", "unknown"),
+                "last_activity": state.get("last_activity", session_data["created_at"]),
+                "rounds": state.get("negotiation_rounds", 0)
+            }
         session_list.append(session_info)
-    
+
     return {"active_sessions": session_list}
 
 @app.get("/session/{session_id}")
-async def get_session_state(session_id: str):
+async def get_session_state(session_id: str, request: Request):
     """Get current session state"""
-    if session_id not in active_sessions:
+    session = await load_session(request.app.state.redis, session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    
+
+    summary = session.get("summary")
+    if summary is not None:
+        return {
+            "session_id": session_id,
+            "state": summary,
+            "archived": True
+        }
     return {
         "session_id": session_id,
-        "state": active_sessions[session_id]["state"]
+        "state": session["state"]
     }
 
 @app.delete("/session/{session_id}")
-async def end_session(session_id: str):
+async def end_session(session_id: str, request: Request):
     """End a negotiation session"""
-    if session_id in active_sessions:
-        del active_sessions[session_id]
+    deleted = await request.app.state.redis.delete(session_key(session_id))
+    if deleted:
         return {"message": "Session ended successfully"}
     else:
         raise HTTPException(status_code=404, detail="Session not found")
 
 @app.get("/")
-async def root():
+async def root(request: Request):
     """Health check endpoint"""
-    return {"message": "Negotiation Agent API is running", "active_sessions": len(active_sessions)}
+    count = 0
+    async for _ in request.app.state.redis.scan_iter(match=SESSION_KEY_PREFIX + "*"):
+        count += 1
+    return {"message": "Negotiation Agent API is running", "active_sessions": count}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3000)
-    
-    # Run command: uvicorn app:app --host 0.0.0.0 --port 3000 --reload
\ No newline at end of file
+    # uvloop + httptools give faster event-loop scheduling and HTTP parsing
+    # than the stdlib defaults. Session state lives in Redis, so workers can
+    # scale with the machine.
+    uvicorn.run("app:app", host="0.0.0.0", port=3000, loop="uvloop", http="httptools", workers=os.cpu_count() or 1)
+
+    # Run command: uvicorn app:app --host 0.0.0.0 --port 3000 --loop uvloop --http httptools
\ No newline at end of file